@@ -1,16 +1,36 @@
 # Copyright 2020 QuantStack
 # Distributed under the terms of the Modified BSD License.
 
+import copy
+import functools
 import logging
 import logging.config
 import os
-from distutils.util import strtobool
+import stat
+import threading
+import weakref
+from pathlib import Path
 from secrets import token_bytes
-from typing import Any, Dict, Iterable, List, NamedTuple, Optional, Type, Union
+from typing import (
+    TYPE_CHECKING,
+    Any,
+    Dict,
+    Iterable,
+    List,
+    NamedTuple,
+    Optional,
+    Tuple,
+    Type,
+    Union,
+)
 
 import appdirs
 import pluggy
-import toml
+
+try:
+    import tomllib
+except ImportError:  # Python < 3.11
+    import tomli as tomllib
 
 from quetz import hooks, pkgstores
 from quetz.errors import ConfigError
@@ -18,11 +38,42 @@ from quetz.errors import ConfigError
 _filename = "config.toml"
 _env_prefix = "QUETZ_"
 _env_config_file = "CONFIG_FILE"
-_site_dir = appdirs.site_config_dir("quetz")
-_user_dir = appdirs.user_config_dir("quetz")
 
 PAGINATION_LIMIT = 20
 
+# parsed config files, keyed by path and validated against (st_mtime_ns, st_size)
+_parsed_cache: Dict[str, Tuple[int, int, Dict[str, Any]]] = {}
+_parsed_cache_lock = threading.Lock()
+_pkg_store_lock = threading.Lock()
+# plugin managers are costly to create (entry points scan), one per config
+_plugin_managers: "weakref.WeakKeyDictionary[Config, pluggy.PluginManager]" = (
+    weakref.WeakKeyDictionary()
+)
+_plugin_managers_lock = threading.Lock()
+
+
+@functools.lru_cache(maxsize=None)
+def _site_dir() -> str:
+    return appdirs.site_config_dir("quetz")
+
+
+@functools.lru_cache(maxsize=None)
+def _user_dir() -> str:
+    return appdirs.user_config_dir("quetz")
+
+
+def _strtobool(value: str) -> bool:
+    """Convert a string representation of truth to True or False.
+
+    Same rules as the deprecated ``distutils.util.strtobool``.
+    """
+    value = value.lower()
+    if value in ("y", "yes", "t", "true", "on", "1"):
+        return True
+    if value in ("n", "no", "f", "false", "off", "0"):
+        return False
+    raise ValueError(f"invalid truth value {value!r}")
+
 
 class ConfigEntry(NamedTuple):
     name: str
@@ -41,7 +92,7 @@ class ConfigEntry(NamedTuple):
     def casted(self, value):
         if self.cast is bool:
             try:
-                value = strtobool(str(value))
+                value = _strtobool(str(value))
             except ValueError as e:
                 raise ConfigError(f"{self.name}: {e}")
 
@@ -54,6 +105,38 @@ class ConfigSection(NamedTuple):
     required: bool = True
 
 
+class _ConfigInstances(weakref.WeakValueDictionary):
+    """Registry of Config instances by path.
+
+    The default instance (stored under the None key) is kept alive, so that
+    the many ``Config()`` calls of the application share it. Instances of
+    other paths are only referenced weakly and are dropped once unused.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self._default: Optional["Config"] = None
+
+    def __setitem__(self, key, value):
+        if key is None:
+            self._default = value
+        super().__setitem__(key, value)
+
+    def __delitem__(self, key):
+        if key is None:
+            self._default = None
+        super().__delitem__(key)
+
+    def pop(self, key, *args):
+        if key is None:
+            self._default = None
+        return super().pop(key, *args)
+
+    def clear(self):
+        self._default = None
+        super().clear()
+
+
 class Config:
     _config_map = [
         ConfigSection(
@@ -120,7 +203,7 @@ class Config:
                 ConfigEntry("redirect_enabled", bool, default=False),
                 ConfigEntry("redirect_endpoint", str, default="/files"),
                 ConfigEntry("redirect_secret", str, default=""),
-                ConfigEntry("redirect_expiration", int, default="3600"),
+                ConfigEntry("redirect_expiration", int, default=3600),
             ],
         ),
         ConfigSection(
@@ -225,49 +308,164 @@ class Config:
             required=False,
         ),
     ]
-    _config_dirs = [_site_dir, _user_dir]
-    _config_files = [os.path.join(d, _filename) for d in _config_dirs]
+    # the site and user config dirs are only looked up once per process
+    _existing_config_files: Optional[List[str]] = None
+
+    # remote package stores in order of precedence: config section, store class
+    # and mapping of store options to config entries. LocalStore is the fallback.
+    _package_stores = (
+        (
+            "s3",
+            pkgstores.S3Store,
+            {
+                'key': 'access_key',
+                'secret': 'secret_key',
+                'url': 'url',
+                'region': 'region',
+                'bucket_prefix': 'bucket_prefix',
+                'bucket_suffix': 'bucket_suffix',
+            },
+        ),
+        (
+            "azure_blob",
+            pkgstores.AzureBlobStore,
+            {
+                'account_name': 'account_name',
+                'account_access_key': 'account_access_key',
+                'conn_str': 'conn_str',
+                'container_prefix': 'container_prefix',
+                'container_suffix': 'container_suffix',
+            },
+        ),
+        (
+            "gcs",
+            pkgstores.GoogleCloudStorageStore,
+            {
+                'project': 'project',
+                'token': 'token',
+                'bucket_prefix': 'bucket_prefix',
+                'bucket_suffix': 'bucket_suffix',
+                'cache_timeout': 'cache_timeout',
+                'region': 'region',
+            },
+        ),
+    )
 
-    _instances: Dict[Optional[str], "Config"] = {}
+    _instances: "_ConfigInstances" = _ConfigInstances()
 
-    def __new__(cls, deployment_config: str = None):
-        if not deployment_config and None in cls._instances:
-            return cls._instances[None]
+    @classmethod
+    def _config_files(cls) -> List[str]:
+        """Config files of the site and user config dirs, resolved on first use."""
+        return [os.path.join(d, _filename) for d in (_site_dir(), _user_dir())]
 
-        try:
-            path = os.path.abspath(cls.find_file(deployment_config))
-        except TypeError:
+    def __new__(cls, deployment_config: str = None):
+        if not deployment_config:
+            config = cls._instances.get(None)
+            if config is not None:
+                return config
+
+        found = cls._open_file(deployment_config)
+        if found:
+            path, fd = found
+            # abspath also normalizes the path, so that different spellings of
+            # the same file share an instance
+            path = os.path.abspath(path)
+        else:
             # if not config path exists, set it to empty string.
-            path = ""
+            path, fd = "", None
 
-        if path not in cls._instances:
-            config = super().__new__(cls)
-            config.init(path)
-            cls._instances[path] = config
-            # optimization - for default config path we also store the instance
-            # under None key
-            if not deployment_config:
-                cls._instances[None] = config
-        return cls._instances[path]
+        try:
+            config = cls._instances.get(path)
+            if config is None:
+                config = super().__new__(cls)
+                config.init(path, fd)
+                cls._instances[path] = config
+                # optimization - for default config path we also store the instance
+                # under None key
+                if not deployment_config:
+                    cls._instances[None] = config
+        finally:
+            if fd is not None:
+                os.close(fd)
+        return config
 
-    def __getattr__(self, name: str) -> Any:
-        super().__getattr__(self, name)
+    if TYPE_CHECKING:
+        # config entries are bound as instance attributes when the config is
+        # loaded, so lookups never need a runtime __getattr__ fallback
+        def __getattr__(self, name: str) -> Any:
+            ...
+
+    def __getstate__(self) -> Dict[str, Any]:
+        # package stores hold client sessions, they are recreated on first use
+        state = self.__dict__.copy()
+        state.pop("_pkg_store", None)
+        return state
+
+    def __setstate__(self, state: Dict[str, Any]) -> None:
+        # __new__ may return an existing instance whose cached store and plugin
+        # manager were built from another config, so both are rebuilt from the
+        # restored state
+        self.__dict__.update(state)
+        self._pkg_store = None
+        with _plugin_managers_lock:
+            _plugin_managers.pop(self, None)
 
     @classmethod
     def find_file(cls, deployment_config: str = None):
-        config_file_env = os.getenv(f"{_env_prefix}{_env_config_file}")
-        deployment_config_files = []
-        for f in (deployment_config, config_file_env):
-            if f and os.path.isfile(f):
-                deployment_config_files.append(f)
+        found = cls._open_file(deployment_config)
+        if found:
+            path, fd = found
+            os.close(fd)
+            return path
+
+    @classmethod
+    def _open_file(cls, deployment_config: str = None) -> Optional[Tuple[str, int]]:
+        """Open the first configuration file found.
+
+        Opening the candidates directly avoids stat-ing them first and lets
+        the configuration be read from the same file descriptor.
+
+        Parameters
+        ----------
+        deployment_config : str, optional
+            The configuration stored at deployment level
+
+        Returns
+        -------
+        found : Optional[Tuple[str, int]]
+            The path of the file and its open file descriptor, which the caller
+            must close, else None.
+        """
+        if cls._existing_config_files is None:
+            cls._existing_config_files = [
+                f for f in cls._config_files() if os.path.isfile(f)
+            ]
 
         # In order, get configuration from:
         # _site_dir, _user_dir, deployment_config, config_file_env
-        for f in cls._config_files + deployment_config_files:
-            if os.path.isfile(f):
-                return f
+        config_file_env = os.getenv(f"{_env_prefix}{_env_config_file}")
+        for f in cls._existing_config_files + [deployment_config, config_file_env]:
+            if not f:
+                continue
+            try:
+                # non-blocking so that a FIFO is not waited on before the
+                # S_ISREG check below, it does not affect regular files
+                fd = os.open(f, os.O_RDONLY | getattr(os, "O_NONBLOCK", 0))
+            except (FileNotFoundError, NotADirectoryError):
+                continue
+            except PermissionError:
+                # like isfile, skip paths that cannot be reached or are not
+                # files (opening a directory fails this way on Windows), but
+                # report unreadable config files
+                if os.path.isfile(f):
+                    raise
+                continue
+            if stat.S_ISREG(os.fstat(fd).st_mode):
+                return f, fd
+            os.close(fd)
+        return None
 
-    def init(self, path: str) -> None:
+    def init(self, path: str, fd: Optional[int] = None) -> None:
         """Load configurations from various places.
 
         Order of importance for configuration is:
@@ -276,17 +474,23 @@ class Config:
 
         Parameters
         ----------
-        deployment_config : str, optional
-            The configuration stored at deployment level
+        path : str
+            The path of the configuration file, or an empty string if none exists
+        fd : int, optional
+            An open file descriptor of the configuration file
         """
 
         self.config: Dict[str, Any] = {}
+        self._pkg_store: Optional[pkgstores.PackageStore] = None
 
         # only try to get config from config file if it exists.
         if path:
-            self.config.update(self._read_config(path))
+            self.config.update(self._read_config(path, fd))
 
         self.config.update(self._get_environ_config())
+        self._configured = frozenset(
+            section for section, value in self.config.items() if value
+        )
         self._trigger_update_config()
 
     def _trigger_update_config(self):
@@ -344,44 +548,54 @@ class Config:
 
         return None
 
-    def _read_config(self, filename: str) -> Dict[str, Any]:
+    def _read_config(self, filename: str, fd: Optional[int] = None) -> Dict[str, Any]:
         """Read a configuration file from its path.
 
+        Parsed files are cached until their modification time or size changes,
+        only the latest version of each path is kept. Callers get their own copy.
+
         Parameters
         ----------
         filename : str
             The path of the configuration file
+        fd : int, optional
+            An open file descriptor of the configuration file, it is not closed
 
         Returns
         -------
         configuration : Dict[str, str]
             The mapping of configuration variables found in the file
         """
-        with open(filename) as f:
+        if fd is None:
+            fd = os.open(filename, os.O_RDONLY)
             try:
-                return dict(toml.load(f))
-            except toml.TomlDecodeError as e:
-                raise ConfigError(f"failed to load config file '{filename}': {e}")
+                return self._read_config(filename, fd)
+            finally:
+                os.close(fd)
+
+        st = os.fstat(fd)
+        with _parsed_cache_lock:
+            cached = _parsed_cache.get(filename)
+            if cached and cached[:2] == (st.st_mtime_ns, st.st_size):
+                return copy.deepcopy(cached[2])
+
+            # config files are small, slurp them with as few reads as possible
+            # instead of going through a buffered file object
+            chunks = []
+            while True:
+                chunk = os.read(fd, st.st_size + 1)
+                chunks.append(chunk)
+                # a short read means we reached the end of the file
+                if len(chunk) <= st.st_size:
+                    break
 
-    def _find_first_level_config(
-        self, section_name: str
-    ) -> Union[ConfigSection, ConfigEntry, None]:
-        """Find the section or entry at first level of config_map.
+            try:
+                data = tomllib.loads(b"".join(chunks).decode())
+            except tomllib.TOMLDecodeError as e:
+                raise ConfigError(f"failed to load config file '{filename}': {e}")
 
-        Parameters
-        ----------
-        section_name : str
-            The name of the section to find.
-
-        Returns
-        -------
-        section : Union[ConfigSection, ConfigEntry, None]
-            The section or entry found, else None.
-        """
-        for item in self._config_map:
-            if section_name == item.name:
-                return item
-        return None
+            _parsed_cache[filename] = (st.st_mtime_ns, st.st_size, data)
+            return copy.deepcopy(data)
 
     def _get_environ_config(self) -> Dict[str, Any]:
         """Looks into environment variables if some matches with config_map.
@@ -399,6 +613,15 @@ class Config:
             for key, value in os.environ.items()
             if key.startswith(_env_prefix)
         }
+        if not quetz_var:
+            return config
+
+        # index the first level of config_map once instead of scanning it for
+        # every variable, the first item wins if a name is registered twice.
+        first_levels: Dict[str, Union[ConfigSection, ConfigEntry]] = {
+            item.name: item for item in reversed(self._config_map)
+        }
+
         for var, value in quetz_var.items():
             splitted_key = var.split('_')
             config_key = splitted_key[1].lower()
@@ -408,7 +631,7 @@ class Config:
             # It must be done in loop as the key itself can contains '_'.
             first_level = None
             while idx < len(splitted_key):
-                first_level = self._find_first_level_config(config_key)
+                first_level = first_levels.get(config_key)
                 if first_level:
                     break
                 config_key += f"_{ splitted_key[idx].lower()}"
@@ -424,67 +647,50 @@ class Config:
             elif isinstance(first_level, ConfigSection):
                 entry = "_".join(splitted_key[idx:]).lower()
                 # the entry does not exist in section, the variable is useless.
-                if entry not in [
-                    section_entry.name for section_entry in first_level.entries
-                ]:
+                if not any(
+                    section_entry.name == entry for section_entry in first_level.entries
+                ):
                     continue
                 # add the entry to the config.
-                if first_level.name not in config:
-                    config[first_level.name]: Dict[str, Any] = {}
-                config[first_level.name]["_".join(splitted_key[idx:]).lower()] = value
+                config.setdefault(first_level.name, {})[entry] = value
 
         return config
 
     def get_package_store(self) -> pkgstores.PackageStore:
         """Return the appropriate package store as set in the config.
 
+        The store is created on first use and shared afterwards.
+
         Returns
         -------
         package_store : pkgstores.PackageStore
             The package store instance to enact package operations against
         """
-        if self.config.get('s3'):
-            return pkgstores.S3Store(
-                {
-                    'key': self.s3_access_key,
-                    'secret': self.s3_secret_key,
-                    'url': self.s3_url,
-                    'region': self.s3_region,
-                    'bucket_prefix': self.s3_bucket_prefix,
-                    'bucket_suffix': self.s3_bucket_suffix,
-                }
-            )
-        elif self.config.get('azure_blob'):
-            return pkgstores.AzureBlobStore(
-                {
-                    'account_name': self.azure_blob_account_name,
-                    'account_access_key': self.azure_blob_account_access_key,
-                    'conn_str': self.azure_blob_conn_str,
-                    'container_prefix': self.azure_blob_container_prefix,
-                    'container_suffix': self.azure_blob_container_suffix,
-                }
-            )
-        elif self.config.get('gcs'):
-            return pkgstores.GoogleCloudStorageStore(
-                {
-                    'project': self.gcs_project,
-                    'token': self.gcs_token,
-                    'bucket_prefix': self.gcs_bucket_prefix,
-                    'bucket_suffix': self.gcs_bucket_suffix,
-                    'cache_timeout': self.gcs_cache_timeout,
-                    'region': self.gcs_region,
-                }
-            )
-        else:
-            return pkgstores.LocalStore(
-                {
-                    'channels_dir': 'channels',
-                    'redirect_enabled': self.local_store_redirect_enabled,
-                    'redirect_endpoint': self.local_store_redirect_endpoint,
-                    'redirect_secret': self.local_store_redirect_secret,
-                    'redirect_expiration': int(self.local_store_redirect_expiration),
-                }
-            )
+        if self._pkg_store is None:
+            with _pkg_store_lock:
+                if self._pkg_store is None:
+                    self._pkg_store = self._create_package_store()
+        return self._pkg_store
+
+    def _create_package_store(self) -> pkgstores.PackageStore:
+        for section, store_class, options in self._package_stores:
+            if self.config.get(section):
+                return store_class(
+                    {
+                        key: getattr(self, f"{section}_{entry}")
+                        for key, entry in options.items()
+                    }
+                )
+
+        return pkgstores.LocalStore(
+            {
+                'channels_dir': 'channels',
+                'redirect_enabled': self.local_store_redirect_enabled,
+                'redirect_endpoint': self.local_store_redirect_endpoint,
+                'redirect_secret': self.local_store_redirect_secret,
+                'redirect_expiration': self.local_store_redirect_expiration,
+            }
+        )
 
     def configured_section(self, section: str) -> bool:
         """Return if a given section has been configured.
@@ -500,7 +706,7 @@ class Config:
             Wether or not the given section is configured
         """
 
-        return bool(self.config.get(section))
+        return section in self._configured
 
     def register(self, extra_config: Iterable[ConfigSection]):
         """Register additional config variables"""
@@ -508,11 +714,16 @@ class Config:
         self._trigger_update_config()
 
 
+@functools.lru_cache(maxsize=None)
+def _config_template() -> str:
+    return Path(__file__).with_name(_filename).read_text()
+
+
 def create_config(
     client_id: str = "",
     client_secret: str = "",
     database_url: str = "sqlite:///./quetz.sqlite",
-    secret: str = token_bytes(32).hex(),
+    secret: Optional[str] = None,
     https: str = 'true',
 ) -> str:
     """Create a configuration file from a template.
@@ -535,10 +746,18 @@ def create_config(
     configuration : str
         The configuration
     """
-    with open(os.path.join(os.path.dirname(__file__), _filename), 'r') as f:
-        config = ''.join(f.readlines())
-
-    return config.format(client_id, client_secret, database_url, secret, https)
+    if secret is None:
+        secret = token_bytes(32).hex()
+
+    return _config_template().format_map(
+        {
+            "client_id": client_id,
+            "client_secret": client_secret,
+            "database_url": database_url,
+            "secret": secret,
+            "https": https,
+        }
+    )
 
 
 def colourized_formatter(fmt="", use_colors=True):
@@ -550,36 +769,26 @@ def colourized_formatter(fmt="", use_colors=True):
         return logging.Formatter(fmt)
 
 
-def get_logger_config(config, loggers):
-    if hasattr(config, "logging_level"):
-        log_level = config.logging_level
-    else:
-        log_level = "INFO"
+_LOG_FORMATTERS = {
+    "colour": {
+        "()": "quetz.config.colourized_formatter",
+        "fmt": "%(levelprefix)s [%(name)s] %(message)s",
+        "use_colors": True,
+    },
+    "basic": {"format": "%(levelprefix)s [%(name)s] %(message)s"},
+    "timestamp": {"format": '%(asctime)s %(levelname)s %(name)s  %(message)s'},
+}
 
-    if hasattr(config, "logging_file"):
-        filename = config.logging_file
-    else:
-        filename = None
 
-    log_level = os.environ.get("QUETZ_LOG_LEVEL", log_level)
-
-    log_level = log_level.upper()
+def get_logger_config(config, loggers):
+    filename = getattr(config, "logging_file", None)
+    log_level = (
+        os.environ.get("QUETZ_LOG_LEVEL")
+        or getattr(config, "logging_level", None)
+        or "INFO"
+    ).upper()
 
     handlers = ["console"]
-    if filename:
-        handlers.append("file")
-
-    LOG_FORMATTERS = {
-        "colour": {
-            "()": "quetz.config.colourized_formatter",
-            "fmt": "%(levelprefix)s [%(name)s] %(message)s",
-            "use_colors": True,
-        },
-        "basic": {"format": "%(levelprefix)s [%(name)s] %(message)s"},
-        "timestamp": {"format": '%(asctime)s %(levelname)s %(name)s  %(message)s'},
-    }
-
-    curdir = os.getcwd()
 
     LOG_HANDLERS = {
         "console": {
@@ -588,20 +797,26 @@ def get_logger_config(config, loggers):
             "level": log_level,
             "stream": "ext://sys.stderr",
         },
-        "file": {
+    }
+
+    # dictConfig instantiates every handler, so only declare the file handler
+    # when it is used, otherwise it would create an empty log file
+    if filename:
+        handlers.append("file")
+        LOG_HANDLERS["file"] = {
             "class": "logging.FileHandler",
             "formatter": "timestamp",
-            "filename": filename or os.path.join(curdir, "quetz.log"),
+            "filename": filename,
             "level": log_level,
-        },
-    }
+        }
 
     LOGGERS = {k: {"level": log_level, "handlers": handlers} for k in loggers}
 
     LOG_CONFIG = {
         "version": 1,
         "disable_existing_loggers": False,
-        "formatters": LOG_FORMATTERS,
+        # formatter settings are flat, copying each of them is a deep copy
+        "formatters": {name: dict(fmt) for name, fmt in _LOG_FORMATTERS.items()},
         "handlers": LOG_HANDLERS,
         "loggers": LOGGERS,
     }
@@ -618,11 +833,24 @@ def configure_logger(config=None, loggers=("quetz", "urllib3.util.retry", "alemb
 
 
 def get_plugin_manager(config=None) -> pluggy.PluginManager:
-    """Create an instance of plugin manager."""
+    """Return the plugin manager of a config, creating it on first use."""
 
     if not config:
         config = Config()
 
+    pm = _plugin_managers.get(config)
+    if pm is None:
+        with _plugin_managers_lock:
+            pm = _plugin_managers.get(config)
+            if pm is None:
+                pm = _create_plugin_manager(config)
+                _plugin_managers[config] = pm
+    return pm
+
+
+def _create_plugin_manager(config: Config) -> pluggy.PluginManager:
+    """Create an instance of plugin manager."""
+
     pm = pluggy.PluginManager("quetz")
     pm.add_hookspecs(hooks)
     if config.configured_section("plugins"):
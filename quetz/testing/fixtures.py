@@ -224,12 +224,12 @@ def config(config_str, config_dir, test_data_dir):
         if os.path.isfile(full_path):
             shutil.copy(full_path, dest)
 
-    Config._instances = {}
+    Config._instances.clear()
     config = Config()
     yield config
     if "QUETZ_CONFIG_FILE" in os.environ:
         del os.environ["QUETZ_CONFIG_FILE"]
-    Config._instances = {}
+    Config._instances.clear()
     os.chdir(old_dir)
 
 
@@ -477,7 +477,7 @@ def empty_config_on_exit() -> None:
         del os.environ["QUETZ_CONFIG_FILE"]
     except KeyError:
         pass
-    Config._instances = {}
+    Config._instances.clear()
 
 
 def test_create_conf(empty_deployment_dir: Path, empty_config_on_exit: None):
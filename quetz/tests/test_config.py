@@ -1,12 +1,24 @@
+import gc
 import logging
 import os
+import pickle
 import tempfile
 
 import pytest
 
-from quetz.config import Config, ConfigEntry, ConfigSection, configure_logger
+from quetz import config as quetz_config
+from quetz.config import (
+    Config,
+    ConfigEntry,
+    ConfigSection,
+    configure_logger,
+    create_config,
+    get_logger_config,
+    get_plugin_manager,
+)
 from quetz.dao import Dao
 from quetz.errors import ConfigError
+from quetz.pkgstores import LocalStore
 
 
 @pytest.fixture
@@ -54,12 +66,20 @@ def test_config_empty_users_section(dao: Dao, user, config):
     assert not config.users_create_default_channel
 
 
+def test_config_unset_section_attributes(config):
+    assert not config.configured_section("gitlab")
+    assert not hasattr(config, "gitlab_client_id")
+
+    with pytest.raises(AttributeError, match="gitlab_client_id"):
+        config.gitlab_client_id
+
+
 def test_config_is_singleton(config):
     c = Config()
 
     assert c is config
 
-    Config._instances = {}
+    Config._instances.clear()
 
     c_new = Config()
 
@@ -78,7 +98,7 @@ def test_config_with_path(config_dir, config_base):
     with open(other_path, 'w') as fid:
         fid.write("\n".join([config_base, "[users]\nadmins=['other']"]))
 
-    Config._instances = {}
+    Config._instances.clear()
 
     c_one = Config(one_path)
 
@@ -95,6 +115,84 @@ def test_config_with_path(config_dir, config_base):
     assert c_new is c_one
 
 
+def test_config_find_file_in_config_dirs(config_dir, config_base, monkeypatch):
+    site_path = os.path.join(config_dir, "site_config.toml")
+    monkeypatch.setattr(Config, "_config_files", lambda: [site_path])
+    monkeypatch.setattr(Config, "_existing_config_files", None)
+
+    assert Config.find_file() is None
+    # directories are not config files
+    assert Config.find_file(config_dir) is None
+
+    with open(site_path, 'w') as fid:
+        fid.write(config_base)
+
+    # config dirs are only looked up once
+    assert Config.find_file() is None
+
+    monkeypatch.setattr(Config, "_existing_config_files", None)
+    assert Config.find_file() == site_path
+    assert Config.find_file("config.toml") == site_path
+
+
+def test_config_unreadable_file(config_dir, config_base, monkeypatch):
+    path = os.path.join(config_dir, "unreadable_config.toml")
+    with open(path, 'w') as fid:
+        fid.write(config_base)
+
+    def os_open(*args, **kwargs):
+        raise PermissionError(13, "Permission denied", path)
+
+    monkeypatch.setattr(quetz_config.os, "open", os_open)
+
+    with pytest.raises(PermissionError):
+        Config(path)
+
+
+def test_config_find_file_skips_unreachable_paths(config_dir, monkeypatch):
+    path = os.path.join(config_dir, "locked", "config.toml")
+
+    def os_open(*args, **kwargs):
+        raise PermissionError(13, "Permission denied", path)
+
+    monkeypatch.setattr(quetz_config.os, "open", os_open)
+
+    assert Config.find_file(path) is None
+    # on Windows, opening a directory raises PermissionError
+    assert Config.find_file(config_dir) is None
+
+
+@pytest.mark.skipif(not hasattr(os, "mkfifo"), reason="requires named pipes")
+def test_config_find_file_skips_fifo(config_dir):
+    path = os.path.join(config_dir, "fifo_config.toml")
+    os.mkfifo(path)
+
+    assert Config.find_file(path) is None
+
+
+def test_config_file_parsed_once(config_dir, config_base, mocker):
+    path = os.path.join(config_dir, "cached_config.toml")
+    with open(path, 'w') as fid:
+        fid.write("\n".join([config_base, "[users]\nadmins=['one']"]))
+
+    load = mocker.spy(quetz_config.tomllib, "loads")
+
+    Config._instances.clear()
+    c_one = Config(path)
+    assert c_one.users_admins == ["one"]
+    Config._instances.clear()
+    assert Config(path).users_admins == ["one"]
+    assert load.call_count == 1
+
+    # the cache is invalidated when the file changes
+    with open(path, 'w') as fid:
+        fid.write("\n".join([config_base, "[users]\nadmins=['other']"]))
+
+    Config._instances.clear()
+    assert Config(path).users_admins == ["other"]
+    assert load.call_count == 2
+
+
 def test_config_extend_require(config):
     with pytest.raises(ConfigError):
         config.register(
@@ -160,3 +258,167 @@ def test_configure_logger(capsys):
     assert captured.err.count("second") == 1
     assert "my test" not in captured.err
     assert len(captured.err.splitlines()) == 1
+
+
+def test_create_config_generates_secret():
+    assert 'secret = "mysecret"' in create_config(secret="mysecret")
+    assert "https_only = false" in create_config(https="false")
+    assert create_config() != create_config()
+
+
+def test_config_package_store_is_cached(config):
+    pkgstore = config.get_package_store()
+
+    assert isinstance(pkgstore, LocalStore)
+    assert pkgstore.redirect_expiration == 3600
+    assert config.get_package_store() is pkgstore
+
+
+def test_config_package_store_after_unpickling(config, config_dir, config_base):
+    pkgstore = config.get_package_store()
+    assert not pkgstore.redirect_enabled
+
+    other_path = os.path.join(config_dir, "other_config.toml")
+    with open(other_path, 'w') as fid:
+        fid.write("\n".join([config_base, "[local_store]\nredirect_enabled = true"]))
+    other = Config(other_path)
+
+    # unpickling goes through Config() which returns the default instance
+    restored = pickle.loads(pickle.dumps(other))
+    assert restored is config
+    assert restored.local_store_redirect_enabled
+    assert restored.get_package_store() is not pkgstore
+    assert restored.get_package_store().redirect_enabled
+
+
+def test_config_plugin_manager_after_unpickling(config, config_dir, config_base):
+    pm = get_plugin_manager(config)
+
+    other_path = os.path.join(config_dir, "other_config.toml")
+    with open(other_path, 'w') as fid:
+        fid.write(config_base)
+    other = Config(other_path)
+
+    # the plugin manager of the restored config is built from its state
+    restored = pickle.loads(pickle.dumps(other))
+    assert restored is config
+    assert get_plugin_manager() is not pm
+    assert get_plugin_manager() is get_plugin_manager(restored)
+
+
+def test_get_logger_config_is_not_shared(config):
+    log_config = get_logger_config(config, ("quetz",))
+
+    assert log_config["loggers"]["quetz"]["handlers"] == ["console"]
+    assert "file" not in log_config["handlers"]
+
+    log_config["loggers"]["quetz"]["level"] = "DEBUG"
+    log_config["formatters"]["colour"]["use_colors"] = False
+
+    other = get_logger_config(config, ["quetz"])
+    assert other is not log_config
+    assert other["loggers"]["quetz"]["level"] == "INFO"
+    assert other["formatters"]["colour"]["use_colors"]
+
+
+def test_get_logger_config_level(config, monkeypatch):
+    log_config = get_logger_config(None, ("quetz",))
+    assert log_config["loggers"]["quetz"]["level"] == "INFO"
+
+    monkeypatch.setenv("QUETZ_LOG_LEVEL", "debug")
+    log_config = get_logger_config(config, ("quetz",))
+    assert log_config["loggers"]["quetz"]["level"] == "DEBUG"
+
+
+def test_get_plugin_manager_is_cached(config):
+    pm = get_plugin_manager(config)
+
+    assert get_plugin_manager() is pm
+
+    Config._instances.clear()
+    assert get_plugin_manager(Config()) is not pm
+
+
+@pytest.mark.parametrize(
+    "value,expected", [("true", True), ("On", True), ("0", False), (False, False)]
+)
+def test_config_entry_casted_bool(value, expected):
+    assert ConfigEntry("flag", bool).casted(value) is expected
+
+
+def test_config_entry_casted_invalid_bool():
+    with pytest.raises(ConfigError, match="flag"):
+        ConfigEntry("flag", bool).casted("maybe")
+
+
+def test_config_from_environ(config_dir, config_base, monkeypatch):
+    path = os.path.join(config_dir, "env_config.toml")
+    with open(path, 'w') as fid:
+        fid.write(config_base)
+
+    monkeypatch.setenv("QUETZ_LOCAL_STORE_REDIRECT_ENABLED", "true")
+    monkeypatch.setenv("QUETZ_USERS_DEFAULT_ROLE", "member")
+    monkeypatch.setenv("QUETZ_USERS_UNKNOWN_ENTRY", "ignored")
+    monkeypatch.setenv("QUETZ_UNKNOWN_SECTION_ENTRY", "ignored")
+
+    Config._instances.clear()
+    config = Config(path)
+
+    assert config.local_store_redirect_enabled
+    assert config.users_default_role == "member"
+    assert config.config["users"] == {"default_role": "member"}
+    assert "unknown_section" not in config.config
+
+
+def test_config_parsed_cache_is_not_shared(config_dir, config_base):
+    path = os.path.join(config_dir, "shared_config.toml")
+    with open(path, 'w') as fid:
+        fid.write("\n".join([config_base, "[users]\nadmins=['one']"]))
+
+    config = Config(path)
+    config.config["users"]["admins"].append("other")
+
+    Config._instances.clear()
+    assert Config(path).config["users"]["admins"] == ["one"]
+
+
+def test_config_instances_are_not_kept_alive(config_dir, config_base):
+    path = os.path.join(config_dir, "weak_config.toml")
+    with open(path, 'w') as fid:
+        fid.write(config_base)
+
+    config = Config(path)
+
+    # different spellings of the same path share the instance
+    assert Config(os.path.join(config_dir, ".", "weak_config.toml")) is config
+    assert path in Config._instances
+
+    del config
+    gc.collect()
+
+    assert path not in Config._instances
+
+
+def test_default_config_is_kept_alive(config_dir, config_base, monkeypatch):
+    path = os.path.join(config_dir, "default_config.toml")
+    with open(path, 'w') as fid:
+        fid.write(config_base)
+    monkeypatch.setenv("QUETZ_CONFIG_FILE", path)
+
+    Config._instances.clear()
+    config_id = id(Config())
+    gc.collect()
+
+    assert id(Config._instances[None]) == config_id
+    assert Config._instances[path] is Config._instances[None]
+
+    Config._instances.clear()
+    assert None not in Config._instances
+
+
+@pytest.mark.parametrize("config_extra", ['[logging]\nfile = "quetz-test.log"'])
+def test_get_logger_config_file(config):
+    log_config = get_logger_config(config, ("quetz",))
+
+    assert log_config["loggers"]["quetz"]["handlers"] == ["console", "file"]
+    assert log_config["handlers"]["file"]["filename"] == "quetz-test.log"